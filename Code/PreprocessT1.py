@@ -5,25 +5,46 @@ Author: Ela Kanani
 
 Required dependencies: 
     * Chris Rorden's dcm2niiX version v1.0.20171215 (OpenJPEG build) GCC7.3.0 (64-bit Linux)
+    * dcm2niiX should be built against CloudFlare's zlib (e.g. following the dcm2niiXL recipe), which accelerates
+      the gz compression that dominates conversion time. Use the NEON-CRC variant on ARM hosts.
 
 Optional dependencies:
-    * 'pigz': allows for faster compression of images
+    * 'pigz': allows for faster compression of images (dcm2niiX pipes its output through pigz when more than two cores are available)
 
 """
-import numpy as np
+import csv
 import os
-import pandas as pd
 import shutil
-import nipype.interfaces.fsl as fsl
+import subprocess
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from pathlib import Path
 # import the nibabel library so we can read in a nifti image
 #import nibabel as nib
 # import the BrainExtractor class
 #from brainextractor import BrainExtractor
 
 
+def availableCPUs():
+    """
+    Counts the cores this process may use, respecting HPC (SLURM) allocations and CPU affinity.
+
+    Returns
+    -------
+    num_cpus : int
+        number of cores available
+
+    """
+    if 'SLURM_CPUS_PER_TASK' in os.environ:
+        return int(os.environ['SLURM_CPUS_PER_TASK'])
+    elif hasattr(os, 'sched_getaffinity'): # only available on Linux
+        return len(os.sched_getaffinity(0))
+    else:
+        return os.cpu_count() or 1 # cpu_count returns None if the number of cores can't be determined
+
+
 class PreprocessT1():
 
-    def __init__(self, subject_id, num_time_points) -> None:
+    def __init__(self, subject_id, num_time_points, num_cpus = None) -> None:
         """
         Initialises instance of the PreprocessT1 object.
 
@@ -35,6 +56,10 @@ class PreprocessT1():
         num_time_points : int
             number of scans in the temporal series
 
+        num_cpus : int
+            number of cores this subject's conversion may use. default is None, in which case all of the cores
+            available to the process are used (see availableCPUs).
+
             
         Returns
         -------
@@ -47,105 +72,118 @@ class PreprocessT1():
         self.num_time_points = num_time_points # the number of temporal scans for the given subject
 
         # create a folder tree with the appropriate file paths for use throughout this method, as according to accompanying doc
-        self.subject_directory_root = '/home/ela/Documents/B-RAPIDD/' + self.subject_id +'/T1-MPRAGE/' # this folder should already exist with the downloaded data
-        self.subject_dicom_directory = self.subject_directory_root + 'original_dicom/' 
+        # (built once as Path objects and reused by every method)
+        self.subject_directory_root = Path('/home/ela/Documents/B-RAPIDD') / self.subject_id / 'T1-MPRAGE' # this folder should already exist with the downloaded data
+        self.subject_dicom_directory = self.subject_directory_root / 'original_dicom'
      
         # create a folder for the converted NIFTI images and brain extractions
-        self.subject_nifti_directory = self.subject_directory_root + 'original_nifti/'
-        os.makedirs(self.subject_nifti_directory, exist_ok=True)
-        self.subject_brain_directory = self.subject_directory_root + 'brain_nifti/'
-        os.makedirs(self.subject_brain_directory, exist_ok=True)
+        self.subject_nifti_directory = self.subject_directory_root / 'original_nifti'
+        self.subject_nifti_directory.mkdir(parents=True, exist_ok=True)
+        self.subject_brain_directory = self.subject_directory_root / 'brain_nifti'
+        self.subject_brain_directory.mkdir(parents=True, exist_ok=True)
+
+        # file name of the converted NIFTI at each time point, e.g. B-RAP_0027_01_D1.nii.gz
+        self.nifti_name_format = self.subject_id + '_{}_D1.nii.gz'
+
+        # resolve dcm2niix once rather than on every conversion, and log its output per subject
+        self.dcm2niix_path = shutil.which('dcm2niix') or 'dcm2niix' # if not found, subprocess raises FileNotFoundError on use
+        self.dcm2niix_log = self.subject_directory_root / 'dcm2niix.log'
+
+        # number of cores this subject's conversion may use
+        self.num_cpus = num_cpus if num_cpus is not None else availableCPUs()
 
         return None
     
-    def findDICOMFolder(self, time_point):
+    def organiseNIFTIFiles(self):
         """
-        Finds the file path of a child folder containing DICOM images only. Useful when there is a large 
-        tree of folders, as often found in the B-RAPIDD set. 
+        dcm2niiX outputs a json file next to each NIFTI file. This function moves the json files into their own
+        folder, and checks that there is exactly one NIFTI file for each time point. dcm2niiX already names the
+        files after their time point, following the same convention as the provided B-RAPIDD dicom scans.
 
         Parameters
         ----------
-        time_point : int
-            Specific time point to process (e.g., first scan would be 1)  
-                
+        None        
+ 
         Returns
         -------
-        folder_path : str
-            string containing the folder path for the folder containing all of the dicom images for a given
-            subject
+        None
 
         """
-        dicom_root_path = self.subject_dicom_directory + self.subject_id+ f'_{str(time_point).zfill(2)}_D1' # save the root path and fill the time_point with a 0
-
-        print(self.subject_id + f'_{str(time_point).zfill(2)}_D1')
-
-        for dirpath, dirnames, filenames in os.walk(dicom_root_path):
-            # Iterate through all folders and files in the root_path and its subdirectories
-            for dirname in dirnames:
-                folder_path = os.path.join(dirpath, dirname) # store the folder path
-                dicom_files = [file for file in os.listdir(folder_path) if file.endswith('.dcm')] # if a dicom file is within the folder, return the path
-                if dicom_files:
-                    return folder_path      
-
+    
+        # sort the files in the current directory into json and nifti files in a single pass
+        json_file_list = []
+        nifti_file_list = []
+        with os.scandir(self.subject_nifti_directory) as entries:
+            for entry in entries:
+                if not entry.is_file(): # skip folders, e.g. json_info
+                    continue
+                if entry.name.endswith('.json'):
+                    json_file_list.append(entry.name)
+                elif entry.name.endswith('.nii.gz'): # ignore anything else that isn't a converted image
+                    nifti_file_list.append(entry.name)
 
+        # move json files into a separate folder called json_info
+        # build the folder prefixes once, rather than joining paths for every file
+        nifti_prefix = os.path.join(self.subject_nifti_directory, '')
+        json_directory =  self.subject_nifti_directory / 'json_info'
+        json_prefix = os.path.join(json_directory, '')
+        json_directory.mkdir(exist_ok=True) # create the json folder if it doesn't exist
+        for file in json_file_list:
+            os.replace(nifti_prefix + file, json_prefix + file)
+
+        # a time point folder holding more than one series (e.g. a localiser or second echo) gives suffixed extra files
+        # (e.g. B-RAP_0027_01_D1_e2.nii.gz), so check that each time point has exactly its own file and nothing else
+        expected_file_list = [self.nifti_name_format.format(f'{index:02d}') for index in range(1, self.num_time_points+1)]
+        if sorted(nifti_file_list) != expected_file_list:
+            raise RuntimeError('Expected one converted image per time point in ' + str(self.subject_nifti_directory)
+                               + ' (' + str(expected_file_list) + ') but found ' + str(sorted(nifti_file_list)))
 
-    def renameNIFTIFiles(self):
+        return None
+            
+            
+    def convertTimePoint(self, time_point, num_threads):
         """
-        dcm2niiX outputted NIFTI and corresponding json files do not follow the desired convention. This function
-        takes the directory of a folder containing NIFTI files and their corresponding json files, and splits them
-        into two folders. Next, each file is renamed to follow the same convention as the provided B-RAPIDD dicom scans.
-        TODO: EDIT THIS FUNCTION SO IT CAN COPE IF FILES ALREADY EXIST AND RENAME APPROPRIATELY
+        Converts a single time point of the current subject's DICOM to NIFTI. Requries Chris Rorden's dcm2niiX.
+        Called concurrently by convertDICOMtoNIFTI for each time point that has not already been converted.
 
         Parameters
         ----------
-        None        
- 
+        time_point : int
+            Specific time point to process (e.g., first scan would be 1)
+
+        num_threads : int
+            number of threads this conversion (dcm2niix and its compression) may use
+
         Returns
         -------
         None
 
         """
-    
-        # need to edit directory input for os processing (must be in the form /home/ela/Documents/B-RAPIDD/subject_id/3D-FLAIR/original_nifti/subject_id_01_D1)
-        #directory = '/home/ela'+ directory
-        # store list of files in the current directory
-        root_file_list = os.listdir(self.subject_nifti_directory)
 
-        # move json files into a separate folder called json_info
-        json_directory =  self.subject_nifti_directory + 'json_info'
-        os.makedirs(json_directory, exist_ok=True) # create the json folder if it doesn't exist
-        for file in root_file_list:
-            if file.endswith('.json'): # if the file is a json file move it
-                shutil.move(os.path.join(self.subject_nifti_directory, file), os.path.join(json_directory, file))
-
-        # sort the json and nifti file names in their corresponding folders in ascending order
-        nifti_file_list = os.listdir(self.subject_nifti_directory) # update nifti-only file list
-        #json_file_list = os.listdir(json_directory) # update nifti-only file list
-        nifti_file_list.sort()
-        nifti_file_list.pop()
-        #json_file_list.sort()
-        print(nifti_file_list)
-
-        # count the number of files, each nifti has a corresponding json so this should be an equal number
-        file_count = len(nifti_file_list)
-
-        # rename the files in each folder to match the naming convention in the accompanying material
-        #for index, (nifti_file_list, json_file_list) in enumerate(zip(nifti_file_list, json_file_list), start=1):
-        for index, nifti_file_list in enumerate(nifti_file_list, start=1):
-            new_file_name = self.subject_id+f'_{str(index).zfill(2)}_D1' # create string of subject ID and padded temporal (e.g. 01) reference, e.g. B-RAP_0027_01_D1
-            new_nifti_name = f"{new_file_name}.nii.gz"
-            #new_json_name = f"{new_file_name}.json"
-            # rename the files
-            os.rename(os.path.join(self.subject_nifti_directory, nifti_file_list), os.path.join(self.subject_nifti_directory, new_nifti_name))
-            #os.rename(os.path.join(json_directory, json_file_list), os.path.join(json_directory, new_json_name))
+        # each dicom folder contains a sub-directory of variable folder names. dcm2niix searches the time point's folder
+        # tree itself (up to 9 folders deep), so there is no need to find the DICOM folder first
+        dicom_root_path = self.subject_dicom_directory / (self.subject_id + f'_{time_point:02d}_D1')
+
+        # name the output after the time point so that concurrent conversions never write to the same file
+        output_name = self.subject_id + f'_{time_point:02d}_D1'
+        # pipe the output through multi-threaded pigz ('o'), unless only a couple of cores are available, where the internal
+        # single-threaded (CloudFlare) zlib ('i') avoids pigz's threads competing for the same cores
+        compression = 'o' if num_threads > 2 else 'i'
+        # limit dcm2niix's threads to its share of the cores
+        dcm2niix_env = dict(os.environ, OMP_NUM_THREADS=str(num_threads))
+        # call the dcm2niix method directly (no shell), raising an error if the conversion fails. The output goes to
+        # the subject's log file rather than the terminal
+        with open(self.dcm2niix_log, 'ab') as log_file:
+            subprocess.run([self.dcm2niix_path, '-o', self.subject_nifti_directory, '-z', compression, '-d', '9', '-f', output_name, dicom_root_path],
+                           stdout=log_file, stderr=subprocess.STDOUT, env=dcm2niix_env, check=True)
 
         return None
-            
-            
+
     def convertDICOMtoNIFTI(self):
         """
         Converts the current subject's DICOM to NIFTI following the file tree structure in folder. 
-        Requries Chris Rorden's dcm2niiX.
+        Requries Chris Rorden's dcm2niiX. Each time point is an independent dcm2niiX process, so
+        the time points are converted concurrently.
 
         Parameters
         -------
@@ -156,49 +194,83 @@ class PreprocessT1():
         None
 
         """
-        
-        # initialse nifti file type
-        nifti_file_format = self.subject_nifti_directory + self.subject_id+'_{}_D1.nii.gz'
 
-        # iterate through all images in the desired number of files
+        # list the already converted files once, rather than checking for each time point's file separately
+        with os.scandir(self.subject_nifti_directory) as entries:
+            existing_files = frozenset(entry.name for entry in entries if entry.is_file())
+
+        # only convert the time points without a nifti file
+        time_points_to_convert = []
         for i in range(self.num_time_points):
-            # each dicom folder contains a sub-directory of variable folder names. Therefore, we need to find the whole path
-            # for the i+1th time point
-            current_dicom_loc = self.findDICOMFolder(i+1)
-            
-            # check if the converted nifti file already exists, if so continue to the next time point
-            current_img_str = str(0)+str(i+1) # current time point string
-            print(nifti_file_format.format(current_img_str))
-            if os.path.isfile(nifti_file_format.format(current_img_str)):
-                continue
-            else: # if the time point needs to be converted
-                dcm2niix_cmd = 'dcm2niix -o ' +  self.subject_nifti_directory + ' -z y -f %f ' + current_dicom_loc
-                # call the dcm2niix method
-                os.system(dcm2niix_cmd)
-
-        # change the nifti file names to fit convention (to match the corresponding DICOM name)
-        self.renameNIFTIFiles()
+            current_img_str = f'{i+1:02d}' # current time point string, zero-padded to two digits
+            if self.nifti_name_format.format(current_img_str) not in existing_files:
+                time_points_to_convert.append(i+1)
+
+        # the work happens in the dcm2niix child processes, so threads are enough to keep all cores busy. The cores are
+        # shared between the conversions running at the same time, so they don't oversubscribe the machine
+        if time_points_to_convert:
+            num_workers = min(len(time_points_to_convert), self.num_cpus)
+            threads_per_conversion = max(1, self.num_cpus // num_workers)
+            with ThreadPoolExecutor(max_workers=num_workers) as executor:
+                list(executor.map(self.convertTimePoint, time_points_to_convert, [threads_per_conversion] * len(time_points_to_convert))) # list() re-raises any conversion errors
+
+        # move the json files out of the way and check each time point was converted to a single, correctly named file
+        self.organiseNIFTIFiles()
 
         return None
-    
 
 
 
-if __name__ == "__main__":
+def convertSubject(subject_id, num_time_points, num_cpus):
+    """
+    Converts all of the temporal scans of one subject from DICOM to NIFTI. Defined at module level so that it
+    can be run in a worker process.
 
-    # open the subject info table and turn into pd dataframe
-    subject_info_df = pd.read_csv('~/Documents/MRes_Project/subject_info.csv')
-    print(subject_info_df) # print current subject info
+    Parameters
+    ----------
+    subject_id : str
+        string including current subject id. e.g. 'B-RAP_0027'
 
-    # select a test patient from the information list
-    test_subject_id = subject_info_df.Subject_ID[0]
-    test_num_time_points = subject_info_df.Time_Points[0]
-    
-    # initialise a preprocess pipeline based on the test subject
-    testPreprocessT1 = PreprocessT1(test_subject_id, test_num_time_points) 
+    num_time_points : int
+        number of scans in the temporal series
+
+    num_cpus : int
+        number of cores this subject's conversion may use
+
+    Returns
+    -------
+    None
+
+    """
+    subjectPreprocessT1 = PreprocessT1(subject_id, num_time_points, num_cpus)
+    subjectPreprocessT1.convertDICOMtoNIFTI()
+
+    return None
+
+
+if __name__ == "__main__":
 
-    # convert all of the temporal scans from DICOM to NIFTI
-    testPreprocessT1.convertDICOMtoNIFTI() #NOTE: Edit this pipeline so that only files are converted if they don't exist
+    # open the subject info table (csv avoids importing pandas)
+    with open(os.path.expanduser('~/Documents/MRes_Project/subject_info.csv'), newline='') as subject_info_file:
+        subject_info_rows = list(csv.DictReader(subject_info_file))
+    print(subject_info_rows) # print subject info
+
+    subject_ids = [row['Subject_ID'] for row in subject_info_rows]
+    num_time_points = [int(row['Time_Points']) for row in subject_info_rows]
+    num_subjects = len(subject_info_rows)
+
+    if num_subjects == 0:
+        print('No subjects to convert')
+    else:
+        # run at most one subject per core, and share the cores between the subjects running at the same time, so that
+        # the per-subject conversions don't oversubscribe the machine
+        num_cpus = availableCPUs()
+        num_workers = min(num_subjects, num_cpus)
+        cpus_per_subject = max(1, num_cpus // num_workers)
+
+        # convert all of the temporal scans from DICOM to NIFTI, one worker process per subject
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            list(executor.map(convertSubject, subject_ids, num_time_points, [cpus_per_subject] * num_subjects)) # list() re-raises any conversion errors
 
 
     
@@ -11,16 +11,20 @@ Required dependencies:
 
 Optional dependencies:
     * 'pigz': allows for faster compression of images
+    * 'numba': compiles the variance map update into a single multi-threaded pass (falls back to NumPy otherwise)
 
 """
 import numpy as np
 import os
 import pandas as pd
 import shutil
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
 import nipype.interfaces.fsl as fsl
 import matplotlib.pyplot as plt
 from pathlib import Path
 import Registration as rg # import my own registration module
+from PreprocessT1 import availableCPUs # cores available, respecting HPC (SLURM) allocations and CPU affinity
 
 # for intensity normalisation
 import nibabel as nib
@@ -33,10 +37,60 @@ from intensity_normalization.plot.histogram import HistogramPlotter, plot_histog
 # import the BrainExtractor class
 #from brainextractor import BrainExtractor
 
+# numba is optional, it is only used to speed up the variance map calculation
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
+
+def welfordUpdate(image, mean, M2, n):
+    """
+    Updates the running mean and M2 (sum of squared differences from the mean) of every voxel in place with the
+    n-th image, following Welford's online algorithm. Replaced by a compiled version below if numba is installed.
+
+    Parameters
+    ----------
+    image : np.array
+        the n-th image of the series
+
+    mean : np.array
+        running mean of each voxel, same shape as image
+
+    M2 : np.array
+        running sum of squared differences from the mean of each voxel, same shape as image
+
+    n : int
+        number of images seen so far, including this one
+
+    Returns
+    -------
+    None
+
+    """
+    delta = image - mean
+    mean += delta / n
+    M2 += delta * (image - mean)
+
+    return None
+
+if njit is not None:
+    @njit(parallel=True, fastmath=True)
+    def welfordUpdate(image, mean, M2, n):
+        # same update as above, fused into a single pass over the voxels with the slices split across threads.
+        # Each voxel is independent, so no combining step is needed. The innermost loop is over the first axis, which
+        # is contiguous in memory for nibabel's (Fortran ordered) arrays
+        for k in prange(image.shape[2]):
+            for j in range(image.shape[1]):
+                for i in range(image.shape[0]):
+                    delta = image[i,j,k] - mean[i,j,k]
+                    mean[i,j,k] += delta / n
+                    M2[i,j,k] += delta * (image[i,j,k] - mean[i,j,k])
+
 
 class Process3DFLAIR():
 
-    def __init__(self, all_subject_info, subject_id, total_num_time_points, time_points_to_consider, registration_method, inter_subject = False) -> None:
+    def __init__(self, all_subject_info, subject_id, total_num_time_points, time_points_to_consider, registration_method, inter_subject = False, debug_plots = False) -> None:
         """
         Initialises instance of the preprocess3DFLAIR object.
 
@@ -61,11 +115,17 @@ class Process3DFLAIR():
            the type of registration to run on the images.
            Options:
                 rigidfsl: rigid registration using FSL's FLIRT
+                rigidmcflirt: rigid registration of all time points at once using FSL's MCFLIRT. Requires the time points
+                              to have the same dimensions, otherwise falls back to rigidfsl
 
         inter_subject: bool
             whether the normalisation should be performed inter or intra subject. default is False. If True,
             then a list of all subject IDs is required.
 
+        debug_plots: bool
+            whether to save histograms of the original and normalised intensities (as PNGs in the normalised_nifti folder)
+            for validation during intensity normalisation. default is False, which skips plotting entirely.
+
 
         Returns
         -------
@@ -80,6 +140,7 @@ class Process3DFLAIR():
         self.time_points_to_consider = time_points_to_consider # the specific scans to analyse
         self.registration_method = registration_method #string including the desired registration method to use
         self.inter_subject = inter_subject # boolean indicating whether inter- or intra- subject normalisation is desired
+        self.debug_plots = debug_plots # boolean indicating whether validation histograms should be saved
 
         # create a folder tree with the appropriate file paths for use throughout this method, as according to accompanying doc
         self.subject_directory_root = '/home/ela/Documents/B-RAPIDD/' + self.subject_id +'/3D-FLAIR/'
@@ -114,6 +175,20 @@ class Process3DFLAIR():
         self.subject_T1_nifti_directory = self.subject_T1_directory + 'original_nifti/'
         self.subject_T1_brain_directory = self.subject_T1_directory + 'brain_nifti/'
 
+        # file name formats for each stage of the pipeline, built once here. Fill them in with the (integer) time point,
+        # which is zero-padded to two digits, e.g. self.nifti_file_format.format(1) ends in B-RAP_0027_01_D1.nii.gz
+        self.nifti_file_format = self.subject_nifti_directory + self.subject_id + '_{:02d}_D1.nii.gz'
+        self.brain_file_format = self.subject_brain_directory + self.subject_id + '_{:02d}_D1.nii.gz'
+        self.brain_mask_file_format = self.subject_brain_mask_directory + self.subject_id + '_{:02d}_D1.nii'
+        self.registered_file_format = self.registered_directory + self.subject_id + '_{:02d}_D1.nii.gz'
+        self.FLIRT_mat_file_format = self.subject_FLIRT_mat_directory + self.subject_id + '_{:02d}_D1_flirt.mat'
+        self.bias_corrected_file_format = self.subject_bias_directory + self.subject_id + '_{:02d}_D1_restore.nii'
+        self.normalised_file_format = self.subject_normalised_directory + self.subject_id + '_{:02d}_D1.nii'
+        self.T1_nifti_file_format = self.subject_T1_nifti_directory + self.subject_id + '_{:02d}_D1.nii.gz'
+        self.T1_brain_file_format = self.subject_T1_brain_directory + self.subject_id + '_{:02d}_D1.nii.gz'
+        self.T1_brain_mask_file_format = self.subject_T1_brain_directory + self.subject_id + '_{:02d}_D1_mask.nii.gz'
+        self.registered_T1_file_format = self.subject_T1_directory + 'T1_in_FLAIR_nifti/' + self.subject_id + '_{:02d}_D1.nii.gz'
+
 
         
         print("Analysing subject: " + self.subject_id)
@@ -136,17 +211,29 @@ class Process3DFLAIR():
             subject
 
         """
-        dicom_root_path = self.subject_dicom_directory + self.subject_id+ f'_{str(time_point).zfill(2)}_D1' 
-
-        print(self.subject_id + f'_{str(time_point).zfill(2)}_D1')
+        dicom_root_path = self.subject_dicom_directory + self.subject_id+ f'_{time_point:02d}_D1' 
+
+        print(self.subject_id + f'_{time_point:02d}_D1')
+
+        # depth-first search of the folder tree, using a stack of folders still to visit
+        folders_to_search = [dicom_root_path]
+        while folders_to_search:
+            folder_path = folders_to_search.pop()
+            # scandir entries already know whether they are files or folders (and their inode), so no extra stat calls are needed
+            sub_folders = []
+            with os.scandir(folder_path) as entries:
+                for entry in entries:
+                    if entry.is_file(follow_symlinks=False) and entry.name.endswith('.dcm'):
+                        return folder_path # stop at the first dicom file found, no need to look at the rest of the folder
+                    if entry.is_dir(follow_symlinks=False):
+                        sub_folders.append((entry.inode(), entry.path))
+            # no dicom files here, so search the sub-folders in inode order. On rotational disks this reads the inode
+            # table close to sequentially rather than seeking back and forth (it makes no difference on SSDs).
+            # The stack is last in, first out, so push the highest inode first
+            sub_folders.sort(reverse=True)
+            folders_to_search.extend(sub_folder for _, sub_folder in sub_folders)
 
-        for dirpath, dirnames, filenames in os.walk(dicom_root_path):
-            # Iterate through all folders and files in the root_path and its subdirectories
-            for dirname in dirnames:
-                folder_path = os.path.join(dirpath, dirname) # store the folder path
-                dicom_files = [file for file in os.listdir(folder_path) if file.endswith('.dcm')] # if a dicom file is within the folder, return the path
-                if dicom_files:
-                    return folder_path      
+        return None
 
 
 
@@ -168,33 +255,37 @@ class Process3DFLAIR():
     
         # need to edit directory input for os processing (must be in the form /home/ela/Documents/B-RAPIDD/subject_id/3D-FLAIR/original_nifti/subject_id_01_D1)
         #directory = '/home/ela'+ directory
-        # store list of files in the current directory
-        root_file_list = os.listdir(self.subject_nifti_directory)
-
-        # move json files into a separate folder called json_info
+        # group the nifti and json files output for each scan by their shared stem in a single pass over the folder
+        converted_files = {} # stem -> {'.nii.gz': file name, '.json': file name}
+        with os.scandir(self.subject_nifti_directory) as entries:
+            for entry in entries:
+                if not entry.is_file(): # skip folders, e.g. json_info
+                    continue
+                for extension in ('.nii.gz', '.json'):
+                    if entry.name.endswith(extension):
+                        converted_files.setdefault(entry.name[:-len(extension)], {})[extension] = entry.name
+                        break
+
+        # json files are moved into a separate folder called json_info
         json_directory =  self.subject_nifti_directory + 'json_info'
         os.makedirs(json_directory, exist_ok=True) # create the json folder if it doesn't exist
-        for file in root_file_list:
-            if file.endswith('.json'): # if the file is a json file move it
-                shutil.move(os.path.join(self.subject_nifti_directory, file), os.path.join(json_directory, file))
+        nifti_prefix = os.path.join(self.subject_nifti_directory, '')
+        json_prefix = os.path.join(json_directory, '')
 
-        # sort the json and nifti file names in their corresponding folders in ascending order
-        nifti_file_list = os.listdir(self.subject_nifti_directory) # update nifti-only file list
-        json_file_list = os.listdir(json_directory) # update nifti-only file list
-        nifti_file_list.sort()
-        json_file_list.sort()
+        # each scan gets its index from the ascending order of the stems, so a nifti and its json always get the same name
+        stems = sorted(stem for stem in converted_files if '.nii.gz' in converted_files[stem])
 
-        # count the number of files, each nifti has a corresponding json so this should be an equal number
-        file_count = len(nifti_file_list)
+        # rename the niftis in two phases so that a new name can never clash with a file that is still to be renamed:
+        # first move every file to a unique temporary name, then to its final name
+        for index, stem in enumerate(stems, start=1):
+            os.replace(nifti_prefix + converted_files[stem]['.nii.gz'], nifti_prefix + f'.tmp_{index}.nii.gz')
 
         # rename the files in each folder to match the naming convention in the accompanying material
-        for index, (nifti_file_list, json_file_list) in enumerate(zip(nifti_file_list, json_file_list), start=1):
-            new_file_name = self.subject_id+f'_{str(index).zfill(2)}_D1' # create string of subject ID and padded temporal (e.g. 01) reference, e.g. B-RAP_0027_01_D1
-            new_nifti_name = f"{new_file_name}.nii.gz"
-            new_json_name = f"{new_file_name}.json"
-            # rename the files
-            os.rename(os.path.join(self.subject_nifti_directory, nifti_file_list), os.path.join(self.subject_nifti_directory, new_nifti_name))
-            os.rename(os.path.join(json_directory, json_file_list), os.path.join(json_directory, new_json_name))
+        for index, stem in enumerate(stems, start=1):
+            new_file_name = self.subject_id+f'_{index:02d}_D1' # create string of subject ID and padded temporal (e.g. 01) reference, e.g. B-RAP_0027_01_D1
+            os.replace(nifti_prefix + f'.tmp_{index}.nii.gz', nifti_prefix + new_file_name + '.nii.gz')
+            if '.json' in converted_files[stem]:
+                os.replace(nifti_prefix + converted_files[stem]['.json'], json_prefix + new_file_name + '.json')
 
         return None
 
@@ -214,35 +305,57 @@ class Process3DFLAIR():
 
         """
         
-        # initialse nifti file type
-        nifti_file_format = self.subject_nifti_directory + self.subject_id+'_{}_D1.nii.gz'
-
-        # iterate through all images in the desired number of files
+        # check which time points still need to be converted, if none then there is nothing to do
+        missing_time_points = []
         for i in range(self.total_num_time_points):
-            # each dicom folder contains a sub-directory of variable folder names. Therefore, we need to find the whole path
-            # for the i+1th time point
-            current_dicom_loc = self.findDICOMFolder(i+1)
-            
-            # check if the converted nifti file already exists, if so continue to the next time point
-            current_img_str = str(0)+str(i+1) # current time point string
-            print(nifti_file_format.format(current_img_str))
-            if os.path.isfile(nifti_file_format.format(current_img_str)):
-                continue
-            else: # if the time point needs to be converted
-                dcm2niix_cmd = 'dcm2niix -o ' +  self.subject_nifti_directory + ' -z y -f %f ' + current_dicom_loc
-                # call the dcm2niix method
-                os.system(dcm2niix_cmd)
+            if not os.path.isfile(self.nifti_file_format.format(i+1)):
+                missing_time_points.append(i+1)
+        if not missing_time_points:
+            # only count the conversion as complete if it didn't leave any extra series behind (see the check below)
+            with os.scandir(self.subject_nifti_directory) as entries:
+                converted_niftis = sorted(entry.name for entry in entries if entry.is_file() and entry.name.endswith('.nii.gz'))
+            if len(converted_niftis) != self.total_num_time_points:
+                raise RuntimeError('Expected ' + str(self.total_num_time_points) + ' converted images in ' + self.subject_nifti_directory
+                                   + ' but found ' + str(len(converted_niftis)) + ': ' + str(converted_niftis))
+            print('All time points already converted.')
+            return None
+
+        # each dicom folder contains a sub-directory of variable folder names. Therefore, we need to find the whole path
+        # for each missing time point. Name the outputs after their time point so they sort among the existing files
+        dcm2niix_runs = [(self.subject_id + f'_{time_point:02d}_D1', self.findDICOMFolder(time_point)) for time_point in missing_time_points]
+
+        # gz compression dominates conversion time, so pipe the output straight through multi-threaded pigz ('o') when it
+        # is installed, otherwise dcm2niix falls back to its internal single-threaded compression
+        compression = 'o' if shutil.which('pigz') else 'y'
+        if compression == 'y':
+            print('pigz not found, compressing with dcm2niix\'s internal (single-threaded) gzip.')
+
+        for output_name, dicom_loc in dcm2niix_runs:
+            # call the dcm2niix method directly (no shell), raising an error if the conversion fails
+            subprocess.run(['dcm2niix', '-o', self.subject_nifti_directory, '-z', compression, '-d', '9', '-f', output_name, dicom_loc], check=True)
+
+        # renameNIFTIFiles numbers the niftis by their sorted order, so any extra series (e.g. a localiser or second echo)
+        # would shift every later time point onto the wrong name. Only rename if there is exactly one nifti per time point
+        with os.scandir(self.subject_nifti_directory) as entries:
+            converted_niftis = sorted(entry.name for entry in entries if entry.is_file() and entry.name.endswith('.nii.gz'))
+        if len(converted_niftis) != self.total_num_time_points:
+            # remove everything this run output (niftis and jsons), so that the failed conversion isn't taken as complete next time
+            run_output_names = tuple(output_name for output_name, _ in dcm2niix_runs)
+            with os.scandir(self.subject_nifti_directory) as entries:
+                for entry in entries:
+                    if entry.is_file() and entry.name.startswith(run_output_names):
+                        os.remove(entry.path)
+            raise RuntimeError('Expected ' + str(self.total_num_time_points) + ' converted images in ' + self.subject_nifti_directory
+                               + ' but found ' + str(len(converted_niftis)) + ': ' + str(converted_niftis)
+                               + '. The images converted by this run have been removed.')
 
         # change the nifti file names to fit convention (to match the corresponding DICOM name)
         self.renameNIFTIFiles()
 
-        # reformat the images into standard format
-        for i in range(self.total_num_time_points):
-            current_img_str = str(0)+str(i+1) # current time point string
-            reorient = fsl.Reorient2Std() 
-            reorient.inputs.in_file = nifti_file_format.format(current_img_str)
-            reorient.inputs.out_file = nifti_file_format.format(current_img_str)
-            res = reorient.run()
+        # reformat the images into standard format, each time point is independent so reorient them concurrently
+        nifti_paths = [self.nifti_file_format.format(i+1) for i in range(self.total_num_time_points)]
+        with ThreadPoolExecutor(max_workers=min(len(nifti_paths), availableCPUs())) as executor:
+            list(executor.map(self.reorientToStandard, nifti_paths)) # list() re-raises any FSL errors
 
         print('Finished conversion and reorientation.')
         return None
@@ -253,24 +366,16 @@ class Process3DFLAIR():
         """
         # takes subject ID and extracts the brains at each time point using BET
 
-        # initialise nifti and brain file format to iterate over
-        nifti_file_format = self.subject_nifti_directory + self.subject_id+'_{}_D1.nii.gz'
-        brain_file_format = self.subject_brain_directory + self.subject_id+'_{}_D1.nii.gz'
-        T1_nifti_file_format = self.subject_T1_nifti_directory + self.subject_id+'_{}_D1.nii.gz'
-        T1_brain_file_format = self.subject_T1_brain_directory + self.subject_id+'_{}_D1.nii.gz'
-        T1_brain_masks_file_format = self.subject_T1_brain_directory + self.subject_id+'_{}_D1_mask.nii.gz'
-        registered_T1_file_format = self.subject_T1_directory + 'T1_in_FLAIR_nifti/' + self.subject_id+'_{}_D1.nii.gz'
-
-
         # iterate through all images in the desired number of time points
         for i in range(len(self.time_points_to_consider)):
-            current_img_str = str(0)+str(self.time_points_to_consider[i]) # current time point string
-            current_brain_loc = brain_file_format.format(current_img_str)
+            current_time_point = self.time_points_to_consider[i]
+            current_img_str = f'{current_time_point:02d}' # current time point string
+            current_brain_loc = self.brain_file_format.format(current_time_point)
             # check if the extracted brain exists for the current time point
             if os.path.exists(current_brain_loc):
                 continue # move onto next time point if the brain is already extracted
             else: # if there isn't an extracted brain
-                current_nifti_loc =  nifti_file_format.format(current_img_str) # current FLAIR image
+                current_nifti_loc =  self.nifti_file_format.format(current_time_point) # current FLAIR image
                 
                 # if we are not using the T1 for brain extraction
                 if useT1 == False: 
@@ -280,8 +385,8 @@ class Process3DFLAIR():
                
                 # if we are using the T1 for brain extraction
                 else: 
-                    current_T1_loc = T1_nifti_file_format.format(current_img_str) # current T1 image
-                    current_registered_T1_loc = registered_T1_file_format.format(current_img_str)
+                    current_T1_loc = self.T1_nifti_file_format.format(current_time_point) # current T1 image
+                    current_registered_T1_loc = self.registered_T1_file_format.format(current_time_point)
                     # Step 1: Register T1 into 3D FLAIR space using FLIRT 
                     # check if the T1 has already been registered into 3D-FLAIR space (i.e. if the file exists, if not then run)
                     if not os.path.isfile(current_registered_T1_loc):
@@ -298,7 +403,7 @@ class Process3DFLAIR():
                         print('Registered T1 to 3D FLAIR at time point: '+ current_img_str)
                     
                     # Step 2: extract T1 brain and create a mask if it doesn't already exist
-                    current_T1_brain = T1_brain_file_format.format(current_img_str) # current T1 brain extracted 
+                    current_T1_brain = self.T1_brain_file_format.format(current_time_point) # current T1 brain extracted 
                     if not os.path.isfile(current_T1_brain): # if the current mask doesn't exist
                         # run BET pipeline
                         T1_bet = fsl.BET()
@@ -312,7 +417,7 @@ class Process3DFLAIR():
                     # Step 3: apply T1 mask to 3D FLAIR
                     apply_mask_BET = fsl.ApplyMask()
                     apply_mask_BET.inputs.in_file = current_nifti_loc # input current 3D FLAIR
-                    apply_mask_BET.inputs.mask_file = T1_brain_masks_file_format.format(current_img_str) 
+                    apply_mask_BET.inputs.mask_file = self.T1_brain_mask_file_format.format(current_time_point) 
                     apply_mask_BET.inputs.out_file = current_brain_loc
                     FLAIR_bet_res = apply_mask_BET.run()
                     print('Extracted 3D-FLAIR brain at time point: ' + current_img_str)
@@ -323,9 +428,12 @@ class Process3DFLAIR():
         
         # extract the brain here, if using a biased registration take the final time point as the template
         brain_template = self.time_points_to_consider[-1] # select last value of the time points to consider for the template
-        # iterate through all of the time points except the last
-        for i in range(len(self.time_points_to_consider)-1):
-            self.applyBETMask(extracted_timepoint=brain_template, to_extract_timepoint=self.time_points_to_consider[i])
+        # register and extract all of the time points except the last. These are independent FSL processes, so run them concurrently
+        to_extract_timepoints = self.time_points_to_consider[:-1]
+        if self.registration_method == 'rigidmcflirt': # register the whole series at once, applyBETMask then only needs to mask
+            self.registerSeriesMCFLIRT(brain_template, to_extract_timepoints)
+        with ThreadPoolExecutor(max_workers=max(1, min(len(to_extract_timepoints), availableCPUs()))) as executor:
+            list(executor.map(self.applyBETMask, [brain_template] * len(to_extract_timepoints), to_extract_timepoints)) # list() re-raises any FSL errors
 
         return None 
     
@@ -349,22 +457,23 @@ class Process3DFLAIR():
 
         """
         
-        # define the file path format layout
-        nifti_file_format = self.subject_nifti_directory + self.subject_id+'_{}_D1.nii.gz'
-        brain_file_mask_format = self.subject_brain_directory + 'masks/'+ self.subject_id+'_{}_D1.nii'  
-        brain_file_format = self.subject_brain_directory + self.subject_id+'_{}_D1.nii.gz' 
-        affine_file_path_format = self.registered_directory + '/FLIRT_mat/' + self.subject_id+'_{}_D1_flirt.mat'
-
-        # specify file names using the above formatting
-        extracted_brain = brain_file_format.format(str(extracted_timepoint).zfill(2))
-        brain_to_extract = nifti_file_format.format(str(to_extract_timepoint).zfill(2)) 
-        mask = brain_file_mask_format.format(str(extracted_timepoint).zfill(2))
-        registered_whole_brain_format = self.registered_directory + self.subject_id+'_{}_D1.nii.gz'
-        registered_whole_brain = registered_whole_brain_format.format(str(to_extract_timepoint).zfill(2))
-        
+        # specify file names using the file formats
+        extracted_brain = self.brain_file_format.format(extracted_timepoint)
+        brain_to_extract = self.nifti_file_format.format(to_extract_timepoint) 
+        mask = self.brain_mask_file_format.format(extracted_timepoint)
+        registered_whole_brain = self.registered_file_format.format(to_extract_timepoint)
+        out_brain = self.brain_file_format.format(to_extract_timepoint)
+
+        # skip this time point if its brain has already been extracted
+        if os.path.isfile(out_brain):
+            print('3D-FLAIR brain already extracted at time point: ' + str(to_extract_timepoint))
+            return None
 
-        # need to register the two time points using desired registration method
-        if self.registration_method == 'rigidfsl': # if we want rigid FLIRT 
+        # need to register the two time points using desired registration method, unless this has already been done
+        register = not os.path.isfile(registered_whole_brain)
+        if not register:
+            print('Time point '+ str(to_extract_timepoint) + ' already registered to ' + str(extracted_timepoint))
+        if register and self.registration_method in ('rigidfsl', 'rigidmcflirt'): # if we want rigid FLIRT (or MCFLIRT could not be used)
             rigidRegister = rg.Registration(reference_path = extracted_brain, target_path = brain_to_extract, out_path = registered_whole_brain)
             rigidRegister.rigidFslFLIRT(cost_function = 'mutualinfo', interpolation = 'trilinear')
             print('Registered time point '+ str(to_extract_timepoint) + ' to ' + str(extracted_timepoint))
@@ -374,9 +483,9 @@ class Process3DFLAIR():
             affineRegister.affineFslFLIRT(cost_function = 'mutualinfo', interpolation = 'trilinear')
             print('Registered time point '+ str(to_extract_timepoint) + ' to ' + str(extracted_timepoint))
         """
-        if self.registration_method == 'nonlinearfsl': #non-linear fsl. NOTE: this requires affine matrix first (RERUN AFFINE)
+        if register and self.registration_method == 'nonlinearfsl': #non-linear fsl. NOTE: this requires affine matrix first (RERUN AFFINE)
             nonlinearRegister = rg.Registration(reference_path = extracted_brain, target_path = brain_to_extract, out_path = registered_whole_brain)
-            affine_file_path = affine_file_path_format.format(str(to_extract_timepoint).zfill(2))
+            affine_file_path = self.FLIRT_mat_file_format.format(to_extract_timepoint)
             nonlinearRegister.nonlinearFslFNIRT(affine_file_path)
             print('Registered time point '+ str(to_extract_timepoint) + ' to ' + str(extracted_timepoint))
         
@@ -384,40 +493,118 @@ class Process3DFLAIR():
         apply_mask_BET = fsl.ApplyMask()
         apply_mask_BET.inputs.in_file = registered_whole_brain
         apply_mask_BET.inputs.mask_file = mask
-        apply_mask_BET.inputs.out_file = brain_file_format.format(str(to_extract_timepoint).zfill(2))
+        apply_mask_BET.inputs.out_file = out_brain
         FLAIR_bet_res = apply_mask_BET.run()
         print('Extracted 3D-FLAIR brain at time point: ' + str(to_extract_timepoint))
 
         return None
 
 
-    def correctBiasField(self, method = 'FSL'):
+    def registerSeriesMCFLIRT(self, extracted_timepoint, to_extract_timepoints):
+        """
+        Rigidly registers several time points to an extracted brain in a single FSL MCFLIRT run, rather than running
+        FLIRT once per time point. The time points are merged into one 4D image, registered to the extracted brain, and
+        split back into the registered images used by applyBETMask. The motion parameters (.par) and the
+        transformation matrix (.mat) of each time point are kept in the registered_nifti/MCFLIRT folder, named after
+        the time point (e.g. B-RAP_0027_01_D1_mcflirt.mat).
 
-        # initialise brain file format to iterate over
-        brain_file_format = self.subject_brain_directory + self.subject_id+'_{}_D1.nii.gz'
-        
-        bias_file_format = self.subject_bias_directory + self.subject_id +'_{}_D1.nii.gz'
+        Parameters
+        ----------
+        extracted_timepoint : int
+            Specific time point of the brain that has been extracted, used as the reference (e.g., last scan would be 5)  
+        to_extract_timepoints : list (of ints)
+            Time points to register to the extracted brain (e.g., [1,2,3,4])
+
+        Returns
+        -------
+        None
+
+        """
+        # only register the time points that haven't been registered already
+        to_register = [time_point for time_point in to_extract_timepoints if not os.path.isfile(self.registered_file_format.format(time_point))]
+        if len(to_register) == 0:
+            return None
+
+        # the time points can only be merged into a 4D image if they share the same dimensions. MCFLIRT also writes the
+        # registered images on their own grid, whereas FLIRT writes them on the reference's, so the template brain and its
+        # mask (applied by applyBETMask afterwards) must share that grid too. The merged (and so registered) series takes
+        # the header of the first time point, so the affines must match as well for every registered image to keep the
+        # template's. Otherwise applyBETMask registers each time point with FLIRT instead
+        brains_to_register = [self.nifti_file_format.format(time_point) for time_point in to_register]
+        grid_paths = brains_to_register + [self.brain_file_format.format(extracted_timepoint), self.brain_mask_file_format.format(extracted_timepoint)]
+        grids = set()
+        for grid_path in grid_paths:
+            grid_header = nib.load(grid_path).header
+            grids.add((grid_header.get_data_shape()[:3], tuple(np.round(grid_header.get_zooms()[:3], 4)),
+                       tuple(np.round(grid_header.get_best_affine(), 4).flatten())))
+        if len(grids) != 1:
+            print('Time points and template have different dimensions, voxel sizes or affines, registering them individually with FLIRT')
+            return None
+
+        MCFLIRT_directory = self.registered_directory + 'MCFLIRT/'
+        os.makedirs(MCFLIRT_directory, exist_ok=True)
+        merged_file = MCFLIRT_directory + self.subject_id + '_series.nii.gz'
+        registered_series_file = MCFLIRT_directory + self.subject_id + '_series_mcf.nii.gz'
+
+        # merge the time points into a 4D image
+        merge = fsl.Merge()
+        merge.inputs.in_files = brains_to_register
+        merge.inputs.dimension = 't'
+        merge.inputs.merged_file = merged_file
+        merge.run()
+
+        # register every volume to the extracted brain
+        mcflirt = fsl.MCFLIRT()
+        mcflirt.inputs.in_file = merged_file
+        mcflirt.inputs.ref_file = self.brain_file_format.format(extracted_timepoint)
+        mcflirt.inputs.cost = 'mutualinfo' # inconsistent intensities, as in Registration.rigidFslFLIRT (rigid, trilinear by default)
+        mcflirt.inputs.save_mats = True
+        mcflirt.inputs.save_plots = True # motion parameters (.par)
+        mcflirt.inputs.out_file = registered_series_file
+        mcflirt_res = mcflirt.run()
+
+        # split the registered series back into one image per time point
+        split = fsl.Split()
+        split.inputs.in_file = registered_series_file
+        split.inputs.dimension = 't'
+        split.inputs.out_base_name = MCFLIRT_directory + self.subject_id + '_vol'
+        split.inputs.output_type = 'NIFTI_GZ'
+        split_res = split.run()
+        # the matrices and motion parameters are numbered by their position in the series, so name them after their
+        # time point instead (a later run with different time points would otherwise overwrite them)
+        mcflirt_mat_file_format = MCFLIRT_directory + self.subject_id + '_{:02d}_D1_mcflirt.mat'
+        mcflirt_par_file_format = MCFLIRT_directory + self.subject_id + '_{:02d}_D1_mcflirt.par'
+        with open(mcflirt_res.outputs.par_file) as par_file:
+            motion_parameters = par_file.readlines() # one line per volume
+        for time_point, registered_volume, mat_file, motion_parameter in zip(to_register, sorted(split_res.outputs.out_files),
+                                                                             mcflirt_res.outputs.mat_file, motion_parameters):
+            os.replace(registered_volume, self.registered_file_format.format(time_point))
+            os.replace(mat_file, mcflirt_mat_file_format.format(time_point))
+            with open(mcflirt_par_file_format.format(time_point), 'w') as par_file:
+                par_file.write(motion_parameter)
+
+        # the merged and registered series are only intermediates
+        os.remove(merged_file)
+        os.remove(registered_series_file)
+        os.remove(mcflirt_res.outputs.par_file)
+        shutil.rmtree(os.path.dirname(mcflirt_res.outputs.mat_file[0]))
+        print('Registered time points ' + str(to_register) + ' to ' + str(extracted_timepoint) + ' with MCFLIRT')
+
+        return None
+
+    def correctBiasField(self, method = 'FSL'):
 
         # correct the bias field of the images 
         if method == 'FSL':
-            brain_nifti_filenames = [] # list of brain file namesPath(nifti_file_format.format(current_img_str)) for later use
-          # iterate through all images in the desired number of time points
-            for i in range(len(self.time_points_to_consider)):
-                current_img_str = str(0)+str(self.time_points_to_consider[i]) # current time point string
-                print('Correcting bias field at time point: ' + current_img_str)
-                current_brain_loc = brain_file_format.format(current_img_str)
-                current_bias_loc = bias_file_format.format(current_img_str)
-                FLAIR_fast = fsl.FAST()
-                FLAIR_fast.inputs.in_files = current_brain_loc
-                FLAIR_fast.inputs.bias_iters = 5
-                FLAIR_fast.inputs.img_type = 1 # T1 should be sufficient for FLAIR
-                FLAIR_fast.inputs.number_classes = 5 # WM, GM, CSF, small lesions, large lesions (like in paper NOTE: add citation from zotero methods)
-                #FLAIR_fast.inputs.out_basename = current_bias_loc, this is broken in nipype
-                FLAIR_fast.inputs.output_biascorrected = True
-                FLAIR_fast.inputs.output_biasfield = True
-                FLAIR_fast_res = FLAIR_fast.run()
-                print('Corrected bias field at time point: ' + current_img_str)
-                brain_nifti_filenames.append(current_brain_loc)
+            # list of brain file names for the time points that have not been bias corrected yet
+            brain_nifti_filenames = [self.brain_file_format.format(time_point) for time_point in self.time_points_to_consider
+                                     if not os.path.isfile(self.bias_corrected_file_format.format(time_point))]
+            if len(brain_nifti_filenames) == 0:
+                print('Bias field already corrected for all time points')
+                return None
+            # each time point is an independent FAST process, so correct them concurrently
+            with ThreadPoolExecutor(max_workers=min(len(brain_nifti_filenames), availableCPUs())) as executor:
+                list(executor.map(self.runFAST, brain_nifti_filenames)) # list() re-raises any FSL errors
 
 
             # Reorganise file tree
@@ -437,7 +624,7 @@ class Process3DFLAIR():
                     elif suffix == "bias":
                         target_path = os.path.join(bias_subfolder, filename)
                         shutil.move(os.path.join(source_folder, filename), target_path)
-                    # delete files that are unneccessary
+                    # delete files that are unneccessary (pve and mixeltype files are only produced if FAST runs its PVE step)
                     elif suffix == "mixeltype":
                         os.remove(os.path.join(source_folder, filename))
                     elif suffix == "seg":
@@ -449,41 +636,160 @@ class Process3DFLAIR():
                     
             return None
 
-    def intensityNormalisation(self, useBiasCorrected = True):
+    def runFAST(self, brain_path):
+        """
+        Runs FSL FAST on a single brain extracted image, saving the bias corrected image and bias field next to it.
+        Called concurrently for each time point by correctBiasField.
+
+        Parameters
+        ----------
+        brain_path : str
+            string including the path of the brain extracted image to correct
+
+        Returns
+        -------
+        FLAIR_fast_res : output of FAST.
+
+        """
+        print('Correcting bias field: ' + brain_path)
+        FLAIR_fast = fsl.FAST()
+        FLAIR_fast.inputs.in_files = brain_path
+        FLAIR_fast.inputs.bias_iters = 5
+        FLAIR_fast.inputs.img_type = 1 # T1 should be sufficient for FLAIR
+        FLAIR_fast.inputs.number_classes = 5 # WM, GM, CSF, small lesions, large lesions (like in paper NOTE: add citation from zotero methods)
+        FLAIR_fast.inputs.no_pve = True # the partial volume estimates are deleted by correctBiasField, so skip computing them
+        #FLAIR_fast.inputs.out_basename = current_bias_loc, this is broken in nipype
+        FLAIR_fast.inputs.output_biascorrected = True
+        FLAIR_fast.inputs.output_biasfield = True
+        FLAIR_fast.inputs.output_type = 'NIFTI' # intermediate files, so save uncompressed for fast (memory-mapped) reloading
+        FLAIR_fast_res = FLAIR_fast.run()
+        print('Corrected bias field: ' + brain_path)
+
+        return FLAIR_fast_res
+
+    def reorientToStandard(self, file_path):
+        """
+        Reorients an image into the standard (MNI) orientation in place, using FSL's fslreorient2std. Images that are
+        already in the standard orientation are skipped, avoiding an FSL process.
+
+        Parameters
+        ----------
+        file_path : str
+            string including the path of the image to reorient
+
+        Returns
+        -------
+        None
+
+        """
+        # fslreorient2std outputs the MNI152 voxel orientation, which is LAS in nibabel's axis codes.
+        # Only the header is read here, so this check is cheap
+        if nib.aff2axcodes(nib.load(file_path).affine) == ('L', 'A', 'S'):
+            return None
+
+        reorient = fsl.Reorient2Std() 
+        reorient.inputs.in_file = file_path
+        reorient.inputs.out_file = file_path
+        res = reorient.run()
+
+        return None
+
+    def plotHistograms(self, images, normalized, masks):
+        """
+        Saves histograms of the intensities before and after normalisation, for validation. The plots are written
+        to the normalised_nifti folder rather than shown, so the pipeline doesn't block on a GUI window.
+
+        Parameters
+        ----------
+        images : list (of np.arrays)
+            images before normalisation
+
+        normalized : list (of np.arrays)
+            images after normalisation
+
+        masks : list (of np.arrays)
+            brain masks for the images, or None to use the whole image
+
+        Returns
+        -------
+        None
+
+        """
+        hp = HistogramPlotter(title="Original Intensities")
+        _ = hp(images, masks)
+        plt.savefig(self.subject_normalised_directory + 'original_intensities_histogram.png')
+        plt.close()
+        hp = HistogramPlotter(title="Nyul Normalised Intensities")
+        _ = hp(normalized, masks)
+        plt.savefig(self.subject_normalised_directory + 'normalised_intensities_histogram.png')
+        plt.close()
+
+        return None
+
+    def intensityNormalisation(self, useBiasCorrected = True, useSavedHistogram = True, save = True):
+        """
+        Normalises the intensities of the current subject's images with Nyul normalisation, fitting the standard
+        histogram on the current subject's images (intra-subject) or on all subjects' images (inter-subject). The
+        normalised images are saved in the subject's normalised_nifti folder, and returned so that later steps
+        can use them without reloading.
+
+        Parameters
+        ----------
+        useBiasCorrected : bool
+            whether to normalise the bias field corrected images (True) or the brain extracted images (False). default is True.
+            Inter-subject normalisation always uses the bias field corrected images.
+
+        useSavedHistogram : bool
+            whether to reuse the standard histogram saved by a previous run, rather than fitting it again. default is True.
+            Intra-subject histograms are saved per set of time points (and per bias corrected/brain images) in the subject's
+            normalised_nifti folder. The inter-subject histogram is saved once for all subjects in the B-RAPIDD folder.
+            Set to False to refit, e.g. after the images or subjects have changed.
+
+        save : bool
+            whether to save the normalised images to the normalised_nifti folder. default is True. Set to False to
+            only keep them in memory, e.g. to pass straight to calcVariance.
+
+        Returns
+        -------
+        normalised_niftis : list (of nib.Nifti1Image)
+            the (in memory) normalised images of the time points to consider, in order.
+
+        """
 
         if self.inter_subject == False: # if we only want to normalise according to the current subject's data
             # save image paths into a list
             if useBiasCorrected == True:
-                brain_file_format = self.subject_bias_directory + self.subject_id +'_{}_D1_restore.nii.gz'
+                brain_file_format = self.bias_corrected_file_format
             else:
-                brain_file_format = self.subject_brain_directory + self.subject_id+'_{}_D1.nii.gz'
+                brain_file_format = self.brain_file_format
             image_paths = [] # initialise variable
             for i in range(len(self.time_points_to_consider)):
-                current_img_str = str(0)+str(self.time_points_to_consider[i]) # current time point string
-                image_paths.append(brain_file_format.format(current_img_str))
-
-            # load in images for processing
-            images = [nib.load(image_path).get_fdata() for image_path in image_paths]        
-
-            # normalise images
+                image_paths.append(brain_file_format.format(self.time_points_to_consider[i]))
+            # load in images for processing, as float32 through the array proxy rather than get_fdata's float64 copy. The
+            # loaded niftis are kept so that their affine and header can be reused when saving, without reopening the files
+            niftis = [nib.load(image_path) for image_path in image_paths]
+            images = [np.asarray(nifti.dataobj, dtype=np.float32) for nifti in niftis]
+            source_niftis = niftis # the images that the saved normalised images are derived from
+
+            # normalise images, only fitting the standard histogram if there isn't one saved already
+            # the saved histogram is named after the images it was fitted on, so it is only reused for the same images
+            fitted_images_str = ('restore' if useBiasCorrected == True else 'brain') + ''.join(f'_{time_point:02d}' for time_point in self.time_points_to_consider)
+            standard_histogram_path = self.subject_normalised_directory + "standard_histogram_" + fitted_images_str + ".npy"
             nyul_norm = NyulNormalize()
-            nyul_norm.fit(images, modality = Modality.FLAIR)
+            if useSavedHistogram and os.path.isfile(standard_histogram_path):
+                nyul_norm.load_standard_histogram(standard_histogram_path)
+            else:
+                nyul_norm.fit(images, modality = Modality.FLAIR)
+                nyul_norm.save_standard_histogram(standard_histogram_path)
             normalized = [nyul_norm(image) for image in images]
-            nyul_norm.save_standard_histogram(self.subject_normalised_directory + "standard_histogram.npy")
         
-            # show histogram of original and corrected images for validation
-            hp = HistogramPlotter(title="Original Intensities")
-            masks = None
-            _ = hp(images, masks)
-            plt.show()
-            hp = HistogramPlotter(title="Nyul Normalised Intensities")
-            masks = None
-            _ = hp(normalized, masks)
-            plt.show()
+            # save histogram of original and corrected images for validation
+            if self.debug_plots:
+                self.plotHistograms(images, normalized, masks = None)
 
         if self.inter_subject == True: # consider all subjects/multiple subjects for normalisation training, requires bias field correction and registration on all. 
-            bias_corrected_brain_format = '/home/ela/Documents/B-RAPIDD/{}/3D-FLAIR/bias_nifti/{}_{}_D1_restore.nii.gz' #1st and 2nd blank are subject IDS, third is timepoint
-            brain_mask_format = '/home/ela/Documents/B-RAPIDD/{}/3D-FLAIR/brain_nifti/masks/{}_{}_D1.nii'
+            bias_corrected_brain_format = '/home/ela/Documents/B-RAPIDD/{0}/3D-FLAIR/bias_nifti/{0}_{1:02d}_D1_restore.nii' # subject ID, then timepoint
+            brain_mask_format = '/home/ela/Documents/B-RAPIDD/{0}/3D-FLAIR/brain_nifti/masks/{0}_{1:02d}_D1.nii'
             image_paths = [] # initialise variables
             mask_paths = []
             image_subject_labels = []
@@ -492,62 +798,72 @@ class Process3DFLAIR():
                 current_subject_ID = self.all_subject_info.Subject_ID[i] # extract the current subject's ID
                 for t in range(self.all_subject_info.Time_Points[i]): # for each time point in the current subject's data
                     # store image paths
-                    current_time_str = str(0)+str(t+1) # current time point string
-                    image_paths.append(bias_corrected_brain_format.format(current_subject_ID, current_subject_ID, current_time_str))
+                    image_paths.append(bias_corrected_brain_format.format(current_subject_ID, t+1))
                     # store mask paths(this will be the same across all brains so repeatedly store the same path t times)
-                    mask_paths.append(brain_mask_format.format(current_subject_ID, current_subject_ID, str(0) + str(self.all_subject_info.Time_Points[i]))) # select the final time point to consider as the mask
+                    mask_paths.append(brain_mask_format.format(current_subject_ID, self.all_subject_info.Time_Points[i])) # select the final time point to consider as the mask
                     # save the corresponding subject labels as a key for the images/positioning of data for a given subject ID
                     image_subject_labels.append(current_subject_ID)
 
-            # load in images for processing
-            images = [nib.load(image_path).get_fdata() for image_path in image_paths]         
+            # the standard histogram only needs fitting once on all of the subjects. If it is saved already, only the current
+            # subject's images need loading and normalising. It is saved in one place shared by all of the subjects
+            standard_histogram_path = '/home/ela/Documents/B-RAPIDD/inter_subject_standard_histogram.npy'
+            use_saved_histogram = useSavedHistogram and os.path.isfile(standard_histogram_path)
+            if use_saved_histogram:
+                current_subject_indices = [i for i, id in enumerate(image_subject_labels) if id == self.subject_id]
+                image_paths = [image_paths[i] for i in current_subject_indices]
+                mask_paths = [mask_paths[i] for i in current_subject_indices]
+                image_subject_labels = [image_subject_labels[i] for i in current_subject_indices]
+
+            # load in images for processing, as float32 through the array proxy rather than get_fdata's float64 copy. The
+            # loaded niftis are kept so that their affine and header can be reused when saving, without reopening the files
+            niftis = [nib.load(image_path) for image_path in image_paths]
+            images = [np.asarray(nifti.dataobj, dtype=np.float32) for nifti in niftis]
             # load in masks for processing
-            masks = [nib.load(mask_path).get_fdata() for mask_path in mask_paths]     
+            masks = [np.asarray(nib.load(mask_path).dataobj, dtype=np.float32) for mask_path in mask_paths]
 
             # normalise images 
             nyul_norm = NyulNormalize()
-            nyul_norm.fit(images, masks, modality = Modality.FLAIR)
+            if use_saved_histogram:
+                nyul_norm.load_standard_histogram(standard_histogram_path)
+            else:
+                nyul_norm.fit(images, masks, modality = Modality.FLAIR)
+                nyul_norm.save_standard_histogram(standard_histogram_path)
             normalized = [nyul_norm(image) for image in images]
-            nyul_norm.save_standard_histogram(self.subject_normalised_directory + "standard_histogram.npy")   
 
-            # show histogram of original and corrected images for validation
-            hp = HistogramPlotter(title="Original Intensities")
-            _ = hp(images, masks)
-            plt.show()
-            hp = HistogramPlotter(title="Nyul Normalised Intensities")
-            _ = hp(normalized, masks)
-            plt.show()       
+            # save histogram of original and corrected images for validation
+            if self.debug_plots:
+                self.plotHistograms(images, normalized, masks)
 
             # only retain the desired subject's normalised data for future use
             current_subject_normalized = []
+            source_niftis = [] # the images that the saved normalised images are derived from
             for i, id in enumerate(image_subject_labels):
                 # check if the current ID matches the subject we are considering
                 if id == self.subject_id:
                     current_subject_normalized.append(normalized[i]) # save the normalised images for the current subject
+                    source_niftis.append(niftis[i])
             normalized = current_subject_normalized # remove images that we are not currently considering
 
-        # save normalised images
-        normalised_file_format = self.subject_normalised_directory + self.subject_id+'_{}_D1.nii.gz'
+        # create the normalised images with the affine and header of the image they were derived from. These are already in
+        # the standard orientation, so the normalised images don't need reorienting. They are saved uncompressed, as they are
+        # reloaded by the later steps
+        normalised_niftis = [] # initialise variable
         for i in range(len(self.time_points_to_consider)):
-            current_img_str = str(0)+str(self.time_points_to_consider[i]) # current time point string
-            norm_nifti = nib.Nifti1Image(normalized[i], affine=np.eye(4))
-            nib.save(norm_nifti, normalised_file_format.format(current_img_str))
+            source_nifti = source_niftis[i]
+            norm_nifti = nib.Nifti1Image(normalized[i].astype(np.float32), affine=source_nifti.affine, header=source_nifti.header)
+            norm_nifti.set_data_dtype(np.float32) # the source header may store integers
+            if save:
+                nib.save(norm_nifti, self.normalised_file_format.format(self.time_points_to_consider[i]))
+            normalised_niftis.append(norm_nifti)
 
-        # reformat the images into standard format
-        for i in range(len(self.time_points_to_consider)):
-            current_img_str = str(0)+str(self.time_points_to_consider[i]) # current time point string
-            reorient = fsl.Reorient2Std() 
-            reorient.inputs.in_file = normalised_file_format.format(current_img_str)
-            reorient.inputs.out_file = normalised_file_format.format(current_img_str)
-            res = reorient.run()
+        return normalised_niftis
 
     def subtractImages(self, in_image_num, image_to_subtract_num, out_file, threshold = False):
         # input = time point flag for images e.g. 1 or 2
 
         # load in the images
-        normalised_file_format = self.subject_normalised_directory + self.subject_id+'_{}_D1.nii.gz'
-        in_image_path = normalised_file_format.format(str(in_image_num).zfill(2))
-        image_to_subtract_path = normalised_file_format.format(str(image_to_subtract_num).zfill(2))
+        in_image_path = self.normalised_file_format.format(in_image_num)
+        image_to_subtract_path = self.normalised_file_format.format(image_to_subtract_num)
 
         # load in images for processing and convert to numpy arrays
         in_image = np.array(nib.load(in_image_path).get_fdata())
@@ -587,47 +903,70 @@ class Process3DFLAIR():
 
         return None
 
-    def calcVariance(self, out_file):
-        # load in the images
-        normalised_file_format = self.subject_normalised_directory + self.subject_id+'_{}_D1.nii.gz'
-        image_paths = [] # initialise variable
-        for i in range(len(self.time_points_to_consider)):
-                    current_img_str = str(0)+str(self.time_points_to_consider[i]) # current time point string
-                    image_paths.append(normalised_file_format.format(current_img_str))
-        # load in images for processing
-        images = [nib.load(image_path).get_fdata() for image_path in image_paths]
+    def calcVariance(self, out_file, normalised_niftis = None):
+        """
+        Calculates the variance of every voxel over the normalised images of the time points to consider, and saves
+        it as a variance map.
 
-        # preallocate array of variances 
-        variances = np.zeros(images[0].shape)
+        Parameters
+        ----------
+        out_file : str
+            string including the path to save the variance map to
 
-        # iterate through each 'voxel' in the images
-        for i in range(variances.shape[0]):
-                for j in range(variances.shape[1]):
-                        for k in range(variances.shape[2]):
-                                voxel_intensities = np.zeros((1, len(self.time_points_to_consider)))
-                                # extract corresponding intensities 
-                                for n in range(len(self.time_points_to_consider)):
-                                    voxel_intensities[0,n] = images[n][i,j,k]
-                                # calculate variance 
-                                variances[i,j,k] = np.var(voxel_intensities)
-
-        # save variance map
-        var_nifti = nib.Nifti1Image(variances, affine=np.eye(4))
+        normalised_niftis : list (of nib.Nifti1Image)
+            normalised images returned by intensityNormalisation. default is None, in which case the images saved in
+            the normalised_nifti folder are used.
+
+        Returns
+        -------
+        None
+
+        """
+        if normalised_niftis is None:
+            # load in the images
+            image_paths = [] # initialise variable
+            for i in range(len(self.time_points_to_consider)):
+                image_paths.append(self.normalised_file_format.format(self.time_points_to_consider[i]))
+            # the normalised images are uncompressed, so they can be memory-mapped and only the slices being used are read
+            niftis = [nib.load(image_path, mmap=True) for image_path in image_paths]
+        else:
+            niftis = normalised_niftis
+        proxies = [nifti.dataobj for nifti in niftis]
+        reference_nifti = niftis[0]
+
+        # calculate the variance of every voxel over the time points with Welford's online algorithm, one slab of
+        # axial slices at a time, so that no full image is held in memory (only the variance map being filled in)
+        variances = np.empty(reference_nifti.shape, dtype=np.float32, order='F') # same memory order as nibabel's arrays
+        slab_depth = 16 # number of axial slices read from each image at a time
+        for z_start in range(0, variances.shape[2], slab_depth):
+            z_end = min(z_start + slab_depth, variances.shape[2])
+            mean = np.zeros(variances[:,:,z_start:z_end].shape, dtype=np.float32, order='F') # running mean of each voxel
+            M2 = np.zeros_like(mean) # running sum of squared differences from the mean
+            for n, proxy in enumerate(proxies, start=1):
+                slab = np.asarray(proxy[:,:,z_start:z_end], dtype=np.float32) # float32 halves the memory of float64
+                welfordUpdate(slab, mean, M2, n)
+            variances[:,:,z_start:z_end] = M2 / len(proxies) # population variance, as np.var
+
+        # save variance map, keeping the spatial information of the input images
+        var_nifti = nib.Nifti1Image(variances, affine=reference_nifti.affine, header=reference_nifti.header)
+        var_nifti.set_data_dtype(np.float32) # the input header may store integers
         nib.save(var_nifti, out_file)
         
         return None
     
-    def runVariancePipeline(self, out_file):
+    def runVariancePipeline(self, out_file, save_normalised = True):
         # Requires images to be in NIFTI already
+        # If save_normalised is False, the normalised images are passed to the variance calculation in memory
+        # rather than being saved and reloaded (note that subtractImages and calcGradientMaps need them saved)
 
         # Step 1) Extract brain using HD-BET and mask
         ##self.extractBrain()
         # Step 2) Perform bias field correction
         self.correctBiasField(method = 'FSL')
         # Step 3) Perform intensity normalisation
-        self.intensityNormalisation(useBiasCorrected = True)
+        normalised_niftis = self.intensityNormalisation(useBiasCorrected = True, save = save_normalised)
         # Step 4: Compute variance map
-        self.calcVariance(out_file)
+        self.calcVariance(out_file, normalised_niftis = normalised_niftis)
 
         print('Completed variance map')
        
@@ -643,16 +982,18 @@ class Process3DFLAIR():
     def calcGradientMaps(self, out_folder, days_between_scans):
         
         # load in all images that are normalised in the time series and their corresponding masks
-        normalised_file_format = self.subject_normalised_directory + '/rigid/' + self.subject_id+'_{}_D1.nii.gz' # only consider rigid registration here
-        brain_file_mask_format = self.subject_brain_directory + 'masks/'+ self.subject_id+'_{}_D1.nii'  
+        normalised_file_format = self.subject_normalised_directory + '/rigid/' + self.subject_id+'_{:02d}_D1.nii' # only consider rigid registration here
         gradient_map_file_format = out_folder + self.subject_id+'_map_{}.nii.gz'  
         image_paths = [] # initialise variables
-        mask_path = brain_file_mask_format.format(str(self.time_points_to_consider[-1]).zfill(2)) # the mask is always the last time point's BET
+        mask_path = self.brain_mask_file_format.format(self.time_points_to_consider[-1]) # the mask is always the last time point's BET
 
-        # create list of paths for masks and images
+        # create list of paths for masks and images. The rigid images are placed here by hand rather than written by
+        # intensityNormalisation, so accept them uncompressed (.nii) or compressed (.nii.gz)
         for i in range(len(self.time_points_to_consider)):
-            current_img_str = str(0)+str(self.time_points_to_consider[i]) # current time point string
-            image_paths.append(normalised_file_format.format(current_img_str))
+            image_path = normalised_file_format.format(self.time_points_to_consider[i])
+            if not os.path.isfile(image_path):
+                image_path = image_path + '.gz'
+            image_paths.append(image_path)
 
         # load in images for processing
         images = [nib.load(image_path).get_fdata() for image_path in image_paths]         
@@ -745,16 +1086,16 @@ class Process3DFLAIR():
             print('Computed map ' + str(map_num) + ' out of ' + str(number_grad_maps))
 
     def calcZScoreMap(self, in_map_path, z_score_out_file, significant_z_out_file, inter_subject_files = [], inter_subject_mask_files = []):
-         # load in the designated map to compute the Z-score for and the brain mask 
-        map_nifti = nib.load(in_map_path).get_fdata()  
-        brain_file_mask_format = self.subject_brain_directory + 'masks/'+ self.subject_id+'_{}_D1.nii'  
-        mask_path = brain_file_mask_format.format(str(self.time_points_to_consider[-1]).zfill(2)) # the mask is always the last time point's BET
-        mask = nib.load(mask_path).get_fdata()   
+        # load in the designated map to compute the Z-score for and the brain mask, as float32 through the array proxy
+        # rather than get_fdata's float64 copy, which halves the data read by the mean and standard deviation
+        map_nifti = np.asarray(nib.load(in_map_path).dataobj, dtype=np.float32)
+        mask_path = self.brain_mask_file_format.format(self.time_points_to_consider[-1]) # the mask is always the last time point's BET
+        mask = np.asarray(nib.load(mask_path).dataobj)
 
         # flatten the map_nifti and the mask
         flat_map = map_nifti.flatten()
         flat_mask = mask.flatten()
-        flat_mask_bool = [not not x for x in flat_mask] # convert np.array to boolean for indexing
+        flat_mask_bool = flat_mask != 0 # convert np.array to boolean for indexing
 
         # only retain the brain values from the flat map
         flat_map_brain = flat_map[flat_mask_bool]
@@ -764,17 +1105,18 @@ class Process3DFLAIR():
         if len(inter_subject_files): # if the input isn't empty
             print('Considering multiple subjects in distribution.')
             for i in range(len(inter_subject_files)): # for all of the other subjects, load in their image and mask
-                flat_current_image = nib.load(inter_subject_files[i]).get_fdata().flatten()
-                flat_current_mask = nib.load(inter_subject_mask_files[i]).get_fdata().flatten()
-                flat_current_mask_bool = [not not x for x in flat_current_mask] # convert np.array to boolean for indexing
+                flat_current_image = np.asarray(nib.load(inter_subject_files[i]).dataobj, dtype=np.float32).flatten()
+                flat_current_mask = np.asarray(nib.load(inter_subject_mask_files[i]).dataobj).flatten()
+                flat_current_mask_bool = flat_current_mask != 0 # convert np.array to boolean for indexing
                 flat_current_brain = flat_current_image[flat_current_mask_bool]
                 # pool the current extracted brain into the intensity list for the flat brains
                 flat_map_brain = np.append(flat_map_brain, flat_current_brain)
 
 
-        # compute mean and standard deviation of sample dependent on the desired distribution
-        mu = np.mean(flat_map_brain)
-        stdev = np.std(flat_map_brain)
+        # compute mean and standard deviation of sample dependent on the desired distribution. These are accumulated in float32:
+        # numpy sums with pairwise summation and np.std subtracts the mean first, so float32 is accurate enough here
+        mu = np.mean(flat_map_brain, dtype=np.float32)
+        stdev = np.std(flat_map_brain, dtype=np.float32)
 
         # preallocate Z-Score map image
         Z_score_map = np.zeros(map_nifti.shape)